@@ -0,0 +1,151 @@
+import os
+import threading
+from contextlib import contextmanager
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # Every test gets its own data directory and a cold in-memory store
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "_CACHE", {"mtime": None, "data": None, "lowered": None, "index": None, "responses": {}})
+    monkeypatch.setattr(main, "_WAL", {"file": None, "size": 0, "pending": [], "pending_size": 0, "timer": None})
+    with TestClient(main.app) as client:
+        yield client
+    main.flush_wal()
+    if main._WAL["file"] is not None:
+        main._WAL["file"].close()
+
+
+@pytest.fixture
+def snapshots(monkeypatch):
+    written = []
+    write_books_file = main.write_books_file
+
+    def counting_write(books):
+        written.append(len(books))
+        return write_books_file(books)
+
+    monkeypatch.setattr(main, "write_books_file", counting_write)
+    monkeypatch.setattr(main, "WAL_COMPACT_SIZE", 2000)
+    # Only explicit flush_wal() calls reach the disk, never the timer
+    monkeypatch.setattr(main, "WAL_FLUSH_DELAY", 3600)
+    return written
+
+
+def add_books(client, count, flush_each=False, start=0):
+    for i in range(start, start + count):
+        response = client.post("/books", json={"title": "Title", "author": "Author", "isbn": f"{i:010d}"})
+        assert response.status_code == 200
+        if flush_each:
+            main.flush_wal()
+
+
+def test_wal_compacts_once_per_threshold_in_a_burst(client, snapshots):
+    # Compact a WAL that was flushed to disk, then keep writing in a burst:
+    # 40 records of ~130 bytes cross a 2000 byte threshold twice, not 25 times
+    add_books(client, 20, flush_each=True)
+    assert len(snapshots) == 1
+    add_books(client, 20, start=20)
+    main.flush_wal()
+    assert len(snapshots) == 2
+    assert os.path.getsize(main.WAL_FILE) < main.WAL_COMPACT_SIZE
+
+
+def test_wal_compacts_once_per_threshold_across_flushes(client, snapshots):
+    # Same 40 records, the same two compactions
+    add_books(client, 40, flush_each=True)
+    assert len(snapshots) == 2
+    assert os.path.getsize(main.WAL_FILE) > 0
+
+
+def restart():
+    # Forget everything in memory, as a crashed and restarted process would
+    if main._WAL["file"] is not None:
+        main._WAL["file"].close()
+    main._WAL.update(file=None, size=0, pending=[], pending_size=0)
+    main._CACHE["data"] = None
+
+
+def test_crash_between_snapshot_and_wal_truncate_keeps_latest_changes(client, monkeypatch):
+    add_books(client, 2, flush_each=True)
+    # Still queued, not yet flushed to the WAL
+    assert client.delete("/books/0000000000").status_code == 200
+    assert client.patch("/books/0000000001/toggle-read").json()["is_read"] is True
+    write_books_file = main.write_books_file
+
+    def crash_after_snapshot(books):
+        write_books_file(books)
+        raise RuntimeError("crash before the WAL is truncated")
+
+    monkeypatch.setattr(main, "write_books_file", crash_after_snapshot)
+    with main.writing_books() as books, pytest.raises(RuntimeError):
+        main.save_books(books)
+    monkeypatch.setattr(main, "write_books_file", write_books_file)
+    restart()
+    assert client.get("/books/0000000000").status_code == 404
+    assert client.get("/books/0000000001").json()["is_read"] is True
+
+
+def test_compacted_store_survives_reload(client, snapshots):
+    add_books(client, 40)
+    before = client.get("/books").json()
+    main.flush_wal()
+    main._CACHE["data"] = None
+    assert client.get("/books").json() == before
+
+
+def test_legacy_isbns_that_are_not_isbns_stay_distinct(client):
+    records = [
+        {"title": "One", "author": "A", "isbn": "book-1", "description": None, "is_read": False},
+        {"title": "Two", "author": "B", "isbn": "1", "description": None, "is_read": False},
+        {"title": "Three", "author": "C", "isbn": "978-0-14-143958-7", "description": None, "is_read": False},
+    ]
+    with open(main.BOOKS_FILE, "wb") as file:
+        file.write(main.ormsgpack.packb(records))
+    assert sorted(book["isbn"] for book in client.get("/books").json()) == ["1", "9780141439587", "book-1"]
+    assert client.get("/books/book-1").json()["title"] == "One"
+    assert client.get("/books/1").json()["title"] == "Two"
+    assert client.get("/books/9780141439587").json()["title"] == "Three"
+
+
+def test_search_and_add_does_not_block_the_event_loop(client, monkeypatch):
+    async def fake_fetch(isbn):
+        return {"title": "Found", "author": "A", "isbn": isbn, "description": None, "is_read": False}
+
+    monkeypatch.setattr(main, "fetch_google_book", fake_fetch)
+    client.get("/books")
+    writing_books = main.writing_books
+    held, release, released, adder_waiting = (threading.Event() for _ in range(4))
+
+    def hold_write_lock():
+        with writing_books():
+            held.set()
+            # The timeout only keeps a blocked event loop from hanging the test
+            release.wait(timeout=10)
+            released.set()
+
+    @contextmanager
+    def signalling_writing_books():
+        adder_waiting.set()
+        with writing_books() as books:
+            yield books
+
+    monkeypatch.setattr(main, "writing_books", signalling_writing_books)
+    holder = threading.Thread(target=hold_write_lock)
+    holder.start()
+    held.wait()
+    adder = threading.Thread(target=client.post, args=("/books/search",), kwargs={"params": {"isbn": "0306406152"}})
+    adder.start()
+    adder_waiting.wait()
+    # Served by the same event loop while the add is stuck on the lock
+    assert client.get("/books/search", params={"isbn": "0441013597"}).status_code == 200
+    assert not released.is_set()
+    release.set()
+    holder.join()
+    adder.join()
+    assert client.get("/books/0306406152").json()["title"] == "Found"